@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
-import socket
+import asyncio
 import json
+import re
+
+HEADER_RE = re.compile(rb"Content-Length: (\d+)")
 
 body = json.dumps({
     "seq": 1,
@@ -9,18 +12,33 @@ body = json.dumps({
     "command": "initialize",
     "adapterID": "dap-gui",
     })
-body_len = len(body.encode("utf8"))
-msg = f"Content-Length: {body_len}\r\n\r\n{body}"
-print(msg)
-
-
-s = socket.socket()
-s.connect(("127.0.0.1", 5678))
-
-s.send(msg.encode("utf8"))
-
-while True:
-    msg = s.recv(1024)
-    print(msg.decode())
-
-
+body_bytes = body.encode("utf8")
+header = f"Content-Length: {len(body_bytes)}\r\n\r\n"
+msg = header.encode("ascii") + body_bytes
+print(header + body)
+
+
+async def main():
+    reader, writer = await asyncio.open_connection("127.0.0.1", 5678)
+
+    writer.write(msg)
+    await writer.drain()
+
+    try:
+        while True:
+            header = await reader.readuntil(b"\r\n\r\n")
+            m = HEADER_RE.search(header)
+            if m is None:
+                raise RuntimeError(f"invalid header: {header!r}")
+            content_length = int(m.group(1))
+            body = await reader.readexactly(content_length)
+            print(json.loads(body))
+    except asyncio.IncompleteReadError:
+        # adapter closed the connection
+        pass
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+asyncio.run(main())
@@ -2,71 +2,72 @@
 
 import argparse
 import json
+import re
 
-from scapy.all import rdpcap, IP, TCP
+from scapy.all import PcapReader, IP, TCP
+
+
+HEADER_RE = re.compile(rb"Content-Length:\s*(\d+)\r\n\r\n")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("file")
     parser.add_argument("-o", "--output", type=argparse.FileType("w"), default="-")
+    parser.add_argument("-p", "--port", type=int, help="DAP server port, used to identify the flow")
     args = parser.parse_args()
 
-    a = rdpcap(args.file)
-
-    combined = b""
+    parts: list[bytes] = []
     pair: set[tuple[str, int, str, int]] = set()
 
-    # first pass: get the DAP ip/port combinations
-    for packet in a:
-        if not hasattr(packet, "load"):
-            continue
+    with PcapReader(args.file) as reader:
+        for packet in reader:
+            if not hasattr(packet, "load"):
+                continue
 
-        ip = packet[IP]
-        tcp = packet[TCP]
-
-        if b"Content-Length" in packet.load:
-            # normal direction
-            pair.add((ip.src, tcp.sport, ip.dst, tcp.dport))
-            # reverse direction
-            pair.add((ip.dst, tcp.dport, ip.src, tcp.sport))
+            ip = packet.getlayer(IP)
+            tcp = packet.getlayer(TCP)
+            if ip is None or tcp is None:
+                continue
 
-    # second pass: extract content
-    for packet in a:
-        if not hasattr(packet, "load"):
-            continue
+            src, dst = ip.src, ip.dst
+            sport, dport = tcp.sport, tcp.dport
+            pair_key = (src, sport, dst, dport)
 
-        ip = packet[IP]
-        tcp = packet[TCP]
-        pair_key = (ip.src, tcp.sport, ip.dst, tcp.dport)
-        if pair_key not in pair:
-            continue
+            if pair_key in pair:
+                parts.append(packet.load)
+                continue
 
-        combined += packet.load
+            if args.port is not None:
+                is_dap = args.port in (sport, dport)
+            else:
+                is_dap = b"Content-Length" in packet.load
 
-    messages = []
-    # parse stream
-    while combined:
-        if not combined.startswith(b"Content-Length"):
-            raise RuntimeError(f"invalid remaining content: {combined.decode()}")
+            # a DAP stream's first segment starts with a Content-Length header,
+            # so earlier packets from the same flow never need to be kept
+            if not is_dap:
+                continue
 
-        combined = combined.lstrip(b"Content-Length:")
-        combined = combined.lstrip(b" ")
+            # normal direction
+            pair.add(pair_key)
+            # reverse direction
+            pair.add((dst, dport, src, sport))
 
-        length = ""
-        while True:
-            if combined[0] < ord("0") or combined[0] > ord("9"):
-                break
-            length += chr(combined[0])
-            combined = combined[1:]
+            parts.append(packet.load)
 
-        content_length = int(length)
-        # strip \r\n\r\n
-        combined = combined[4:]
+    combined = b"".join(parts)
+    messages = []
+    # parse stream
+    pos = 0
+    while pos < len(combined):
+        m = HEADER_RE.match(combined, pos)
+        if m is None:
+            raise RuntimeError(f"invalid remaining content: {combined[pos:].decode()}")
 
-        json_str = combined[:content_length]
-        combined = combined[content_length:]
+        content_length = int(m.group(1))
+        body_start = m.end()
+        pos = body_start + content_length
 
-        messages.append(json.loads(json_str.decode()))
+        messages.append(json.loads(combined[body_start:pos]))
 
     json.dump(messages, args.output, indent=2)
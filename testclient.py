@@ -3,34 +3,89 @@
 from __future__ import annotations
 
 import asyncio
+import atexit
 import os
 import time
 from threading import Event, Thread
-from collections import defaultdict
 import sys
 from enum import Enum
 from dataclasses import dataclass
 import json
 import socket
 from typing import Any, Literal, TypedDict, cast, Generator
-from queue import Queue
+from queue import SimpleQueue
 import structlog
 import logging
 
-logging.basicConfig(level=logging.DEBUG, filename="log.log", filemode="w", format="%(message)s")
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+
+    # log events include dicts keyed by thread id
+    LOG_DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def log_dumps(obj: Any, **kwargs) -> bytes:
+        return orjson.dumps(obj, option=LOG_DUMPS_OPTIONS, **kwargs)
+
+except ImportError:
+
+    def json_dumps(obj: Any, **kwargs) -> bytes:
+        # json.dumps escapes non-ASCII characters by default
+        return json.dumps(obj, separators=(",", ":"), **kwargs).encode("ascii")
+
+    def json_loads(data: bytes | memoryview) -> Any:
+        # unlike orjson, json.loads does not accept memoryview
+        return json.loads(bytes(data))
+    log_dumps = json_dumps
+
+
+# file-like object that hands log lines to a writer thread so callers never block on disk I/O
+class BackgroundLogFile:
+    def __init__(self, path: str):
+        self.file = open(path, "wb")
+        self.queue: SimpleQueue[bytes | None] = SimpleQueue()
+        self.thread = Thread(target=self.drain, name="log-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, data: bytes):
+        self.queue.put(data)
+
+    def flush(self):
+        # flushing happens on the writer thread once the queue is empty
+        pass
+
+    def drain(self):
+        while (data := self.queue.get()) is not None:
+            self.file.write(data)
+            if self.queue.empty():
+                self.file.flush()
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+LOG_LEVEL = logging.DEBUG
+# skip building per-message debug events when they would be filtered out
+DEBUG_ENABLED = LOG_LEVEL <= logging.DEBUG
+
 structlog.configure(
     processors=[
         structlog.contextvars.merge_contextvars,
         structlog.processors.add_log_level,
-        structlog.processors.StackInfoRenderer(),
-        structlog.dev.set_exc_info,
-        structlog.processors.TimeStamper(),
-        structlog.processors.JSONRenderer(),
+        structlog.processors.TimeStamper(fmt="iso", utc=True),
+        # only does work for events that pass exc_info
+        structlog.processors.format_exc_info,
+        structlog.processors.JSONRenderer(serializer=log_dumps),
     ],
-    wrapper_class=structlog.stdlib.BoundLogger,
+    wrapper_class=structlog.make_filtering_bound_logger(LOG_LEVEL),
     context_class=dict,
-    logger_factory=structlog.stdlib.LoggerFactory(),
-    cache_logger_on_first_use=False,
+    logger_factory=structlog.BytesLoggerFactory(file=BackgroundLogFile("log.log")),
+    cache_logger_on_first_use=True,
 )
 
 LOG = structlog.get_logger()
@@ -51,24 +106,137 @@ class Response(ServerMessage):
     body: Any | None
 
 
-@dataclass
-class Header:
-    content_length: int
+CONTENT_LENGTH_PREFIX = b"Content-Length: "
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", None)
+# Linux only: acknowledge reads immediately rather than waiting to piggyback on a reply
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)
+
+
+def frame_message(body: bytes) -> bytes:
+    return b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
 
 
 def serislise_message(msg: dict) -> bytes:
-    m = json.dumps(msg)
-    n = len(m)
-
-    header = f"Content-Length: {n}"
-    message_str = "\r\n".join(
-        [
-            header,
-            "",
-            m,
-        ]
-    )
-    return message_str.encode("utf8")
+    return frame_message(json_dumps(msg))
+
+
+# placeholder for an integer argument that Client.send_prepared fills in per request
+INT_ARGUMENT = "<int>"
+
+
+# a request with a fixed shape, serialised once with slots for integer arguments and the seq
+@dataclass(frozen=True, slots=True)
+class PreparedRequest:
+    msg: dict
+    template: bytes
+    # keys in msg["arguments"] that are filled in per request, in template order
+    argument_names: tuple[str, ...]
+
+    @classmethod
+    def from_msg(cls, msg: dict) -> PreparedRequest:
+        encoded = json_dumps(msg)
+        argument_names = tuple(
+            name for name, value in msg.get("arguments", {}).items() if value == INT_ARGUMENT
+        )
+        if encoded.count(json_dumps(INT_ARGUMENT)) != len(argument_names):
+            raise ValueError(f"integer arguments must be direct members of arguments: {msg}")
+
+        body = encoded.replace(b"%", b"%%").replace(json_dumps(INT_ARGUMENT), b"%d")
+        template = body[:-1] + b',"seq":%d,"type":"request"}'
+        return cls(msg=msg, template=template, argument_names=argument_names)
+
+    # the request as sent, with the integer arguments filled in
+    def envelope(self, seq: int, *arguments: int) -> dict:
+        request = self.msg.copy()
+        if arguments:
+            fields = request["arguments"] = request["arguments"].copy()
+            for name, argument in zip(self.argument_names, arguments):
+                fields[name] = argument
+        request["seq"] = seq
+        request["type"] = "request"
+        return request
+
+
+INITIALIZE_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "initialize",
+        "arguments": {
+            "adapterID": "dap-gui",
+            "clientName": "DAP GUI",
+            "pathFormat": "path",
+            # TODO
+            "supportsRunInTerminalRequest": False,
+            "supportsStartDebuggingRequest": False,
+        },
+    }
+)
+
+DISCONNECT_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "disconnect",
+        "terminateDebuggee": True,
+    }
+)
+
+CONFIGURATION_DONE_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "configurationDone",
+    }
+)
+
+THREADS_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "threads",
+    }
+)
+
+ATTACH_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "attach",
+        "arguments": {
+            "name": "Python: Remote Attach (ext)",
+            "type": "python",
+            "request": "attach",
+            "justMyCode": False,
+        },
+    }
+)
+
+VARIABLES_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "variables",
+        "arguments": {"variablesReference": INT_ARGUMENT},
+    }
+)
+
+STACK_TRACE_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "stackTrace",
+        "arguments": {
+            "threadId": INT_ARGUMENT,
+        },
+    }
+)
+
+SCOPES_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "scopes",
+        "arguments": {
+            "frameId": INT_ARGUMENT,
+        },
+    }
+)
+
+SET_FUNCTION_BREAKPOINTS_REQUEST = PreparedRequest.from_msg(
+    {
+        "command": "setFunctionBreakpoints",
+        "arguments": {
+            "breakpoints": [
+                {"name": "main"},
+            ],
+        },
+    }
+)
 
 
 class ThreadStatus(Enum):
@@ -76,7 +244,7 @@ class ThreadStatus(Enum):
     exited = "exited"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class StackFrame:
     id: int
     name: str
@@ -93,7 +261,7 @@ class StackFrame:
         return frame
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class StackFrameSource:
     path: str
 
@@ -101,14 +269,14 @@ class StackFrameSource:
 ThreadId = int
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Scope:
     variables_reference: int
     name: str
     expensive: bool
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Variable:
     name: str
     value: str
@@ -120,13 +288,15 @@ class Handler:
     thread_status: dict[ThreadId, ThreadStatus]
     stack_frames: dict[ThreadId, list[StackFrame] | None]
     scopes: dict[int, list[Scope]]
-    variables: dict[int, list[Variable]]
+    variable_names: list[str]
+    variable_values: list[str]
+    variable_types: list[str]
+    variable_ranges: dict[int, tuple[int, int]]
     wait_event: Event | None
 
-    def __init__(self, client: Client, events: Queue):
+    def __init__(self, client: Client):
         self.client = client
         self.awaiting_response = {}
-        self.queue = events
         self.wait_event = None
 
         # state about the debug adapter
@@ -136,7 +306,39 @@ class Handler:
         self.thread_status = {}
         self.stack_frames = {}
         self.scopes = {}
-        self.variables = defaultdict(list)
+        # variables from every response share flat per-field lists; variable_ranges maps each
+        # variablesReference to its (start, end) slice
+        self.variable_names = []
+        self.variable_values = []
+        self.variable_types = []
+        self.variable_ranges = {}
+
+        # the program path is resolved once, so the whole launch request can be prepared up front
+        self.launch_request = PreparedRequest.from_msg(
+            {
+                "command": "launch",
+                "arguments": {
+                    "program": os.path.join(os.getcwd(), "test.py"),
+                },
+            }
+        )
+
+        self.response_handlers = {
+            "initialize": self.on_initialize_response,
+            "setFunctionBreakpoints": self.on_set_function_breakpoints_response,
+            "threads": self.on_threads_response,
+            "stackTrace": self.on_stack_trace_response,
+            "scopes": self.on_scopes_response,
+            "variables": self.on_variables_response,
+            "disconnect": self.on_disconnect_response,
+        }
+        self.event_handlers = {
+            "initialized": self.on_initialized_event,
+            "stopped": self.on_stopped_event,
+            "output": self.on_output_event,
+            "thread": self.on_thread_event,
+            "terminated": self.on_terminated_event,
+        }
 
     def wait_for_connect(self):
         self.wait_event = Event()
@@ -148,231 +350,207 @@ class Handler:
     def initialised(self) -> bool:
         return len(self.capabilities) > 0
 
-    def loop(self):
-        while True:
-            res = self.queue.get()
-            match res["type"]:
-                case "response":
-                    self.handle_response(cast(Response, res))
-                case "event":
-                    self.handle_event(res)
-                case t:
-                    raise NotImplementedError(t)
+    def dispatch(self, res: ServerMessage):
+        match res["type"]:
+            case "response":
+                self.handle_response(cast(Response, res))
+            case "event":
+                self.handle_event(res)
+            case t:
+                raise NotImplementedError(t)
 
     def handle_response(self, res: Response):
         req = self.awaiting_response.pop(res["request_seq"], None)
         if not req:
             return
-        LOG.debug("response", type="response", response=res, request=req)
+        if DEBUG_ENABLED:
+            LOG.debug("response", type="response", response=res, request=req)
 
         if not res["success"]:
             LOG.warning("failed response", response=res, request=req)
             raise RuntimeError(res)
 
-        match res["command"]:
-            case "initialize":
-                self.capabilities = res["body"]
-                self.clear_awaiting(res)
+        handler = self.response_handlers.get(res["command"])
+        if handler:
+            handler(res, req)
+
+    def on_initialize_response(self, res: Response, req: dict):
+        self.capabilities = res["body"]
+        self.clear_awaiting(res)
+
+        self.send_attach()
+
+    def on_set_function_breakpoints_response(self, res: Response, req: dict):
+        self.configuration_done()
 
-                self.send_attach()
-
-            case "setFunctionBreakpoints":
-                self.configuration_done()
-
-            case "threads":
-                body = res["body"]
-                self.stack_frames.clear()
-            #     for thread in body["threads"]:
-            #         self.stack_frames[thread["id"]] = None
-            #         self.send_stack_trace(thread["id"])
-
-            # TODO: wait for the results of these requests
-            # self.send_continue()
-
-            case "stackTrace":
-                body = res["body"]
-                stack_frames = body["stackFrames"]
-                frames = []
-                for raw_frame in stack_frames:
-                    frame = StackFrame.from_raw(raw_frame)
-                    self.send_scopes(frame)
-                    frames.append(frame)
-
-                thread_id = req["arguments"]["threadId"]
-                self.stack_frames[thread_id] = frames
-
-            case "scopes":
-                body = res["body"]
-                scopes = []
-                for raw_scope in body["scopes"]:
-                    scope = Scope(
-                        variables_reference=raw_scope["variablesReference"],
-                        name=raw_scope["name"],
-                        expensive=raw_scope["expensive"],
-                    )
-                    scopes.append(scope)
-                    if scope.variables_reference > 0 and not scope.expensive:
-                        self.send_variables(scope.variables_reference)
-
-                frame_id = req["arguments"]["frameId"]
-                self.scopes[frame_id] = scopes
+    def on_threads_response(self, res: Response, req: dict):
+        self.stack_frames.clear()
+        # body = res["body"]
+        # for thread in body["threads"]:
+        #     self.stack_frames[thread["id"]] = None
+        #     self.send_stack_trace(thread["id"])
+
+        # TODO: wait for the results of these requests
+        # self.send_continue()
+
+    def on_stack_trace_response(self, res: Response, req: dict):
+        body = res["body"]
+        stack_frames = body["stackFrames"]
+        frames = []
+        for raw_frame in stack_frames:
+            frame = StackFrame.from_raw(raw_frame)
+            self.send_scopes(frame)
+            frames.append(frame)
+
+        thread_id = req["arguments"]["threadId"]
+        self.stack_frames[thread_id] = frames
+
+    def on_scopes_response(self, res: Response, req: dict):
+        body = res["body"]
+        scopes = []
+        variables_references = []
+        for raw_scope in body["scopes"]:
+            scope = Scope(
+                variables_reference=raw_scope["variablesReference"],
+                name=raw_scope["name"],
+                expensive=raw_scope["expensive"],
+            )
+            scopes.append(scope)
+            if scope.variables_reference > 0 and not scope.expensive:
+                variables_references.append(scope.variables_reference)
+
+        if variables_references:
+            self.send_variables_many(variables_references)
+
+        frame_id = req["arguments"]["frameId"]
+        self.scopes[frame_id] = scopes
+        self.clear_awaiting(res)
+
+    def on_variables_response(self, res: Response, req: dict):
+        body = res["body"]
+        variable_ref = req["arguments"]["variablesReference"]
+        append_name = self.variable_names.append
+        append_value = self.variable_values.append
+        append_type = self.variable_types.append
+        start = len(self.variable_names)
+        for variable in body["variables"]:
+            if (ref := variable.get("variablesReference")) > 0:
+                # TODO decode further
+                break
+                self.send_variables(variable["variablesReference"])
                 self.clear_awaiting(res)
+            else:
+                # if variable_ref in self.variable_ranges:
+                #     raise ValueError(f"Already encountered variable {variable_ref}: {variable}")
+                append_name(variable["name"])
+                append_value(variable["value"])
+                append_type(variable["type"])
+            self.clear_awaiting(res)
+
+        self.variable_ranges[variable_ref] = (start, len(self.variable_names))
+        if DEBUG_ENABLED:
+            LOG.debug("variables", count=len(self.variable_names))
+
+    def variables_for(self, variables_reference: int) -> list[Variable]:
+        start, end = self.variable_ranges.get(variables_reference, (0, 0))
+        return [
+            Variable(name=name, value=value, typ=typ)
+            for name, value, typ in zip(
+                self.variable_names[start:end],
+                self.variable_values[start:end],
+                self.variable_types[start:end],
+            )
+        ]
 
-            case "variables":
-                body = res["body"]
-                for variable in body["variables"]:
-                    if (ref := variable.get("variablesReference")) > 0:
-                        # TODO decode further
-                        return
-                        self.send_variables(variable["variablesReference"])
-                        self.clear_awaiting(res)
-                    else:
-                        v = Variable(
-                            name=variable["name"],
-                            value=variable["value"],
-                            typ=variable["type"],
-                        )
-                        variable_ref = req["arguments"]["variablesReference"]
-                        # if variable_ref in self.variables:
-                        #     raise ValueError(f"Already encountered variable {variable_ref}: {v}")
-                        self.variables[variable_ref].append(v)
-                        LOG.debug(
-                            "variables",
-                            count=sum(len(self.variables[key]) for key in self.variables),
-                        )
-                    self.clear_awaiting(res)
-
-            case "disconnect":
-                self.client.disconnect()
-                LOG.debug("disconnect")
-                raise SystemExit(0)
+    def on_disconnect_response(self, res: Response, req: dict):
+        self.client.disconnect()
+        LOG.debug("disconnect")
+        raise SystemExit(0)
 
     def clear_awaiting(self, response: Response):
         self.awaiting_response.pop(response["request_seq"], None)
 
     def handle_event(self, event: ServerMessage):
-        LOG.debug("event", message=event)
-
-        match event["event"]:
-            case "initialized":
-                self.initialized = True
-                self.set_function_breakpoints()
-            case "stopped":
-                if self.wait_event and not self.wait_event.is_set():
-                    self.wait_event.set()
-
-                self.current_thread = event["body"]["threadId"]
-                self.reset_state()
-                self.send_threads()
-                self.send_stack_trace(self.current_thread)
-            case "output":
-                body = event["body"]
-                match body["category"]:
-                    case "stdout":
-                        print(body["output"])
-                    case "stderr":
-                        print(body["output"], file=sys.stderr)
-            case "thread":
-                body = event["body"]
-                thread_id = body["threadId"]
-                status = ThreadStatus(body["reason"])
-                self.thread_status[thread_id] = status
-                LOG.debug("thread", status=self.thread_status)
-            case "terminated":
-                self.send_disconnect()
+        if DEBUG_ENABLED:
+            LOG.debug("event", message=event)
+
+        handler = self.event_handlers.get(event["event"])
+        if handler:
+            handler(event)
+
+    def on_initialized_event(self, event: ServerMessage):
+        self.initialized = True
+        self.set_function_breakpoints()
+
+    def on_stopped_event(self, event: ServerMessage):
+        if self.wait_event and not self.wait_event.is_set():
+            self.wait_event.set()
+
+        self.current_thread = event["body"]["threadId"]
+        self.reset_state()
+        self.send_threads()
+        self.send_stack_trace(self.current_thread)
+
+    def on_output_event(self, event: ServerMessage):
+        body = event["body"]
+        match body["category"]:
+            case "stdout":
+                print(body["output"])
+            case "stderr":
+                print(body["output"], file=sys.stderr)
+
+    def on_thread_event(self, event: ServerMessage):
+        body = event["body"]
+        thread_id = body["threadId"]
+        status = ThreadStatus(body["reason"])
+        self.thread_status[thread_id] = status
+        if DEBUG_ENABLED:
+            LOG.debug("thread", status=self.thread_status)
+
+    def on_terminated_event(self, event: ServerMessage):
+        self.send_disconnect()
 
     def reset_state(self):
         self.stack_frames.clear()
         self.scopes.clear()
 
     def send_initialize(self):
-        msg = {
-            "command": "initialize",
-            "arguments": {
-                "adapterID": "dap-gui",
-                "clientName": "DAP GUI",
-                "pathFormat": "path",
-                # TODO
-                "supportsRunInTerminalRequest": False,
-                "supportsStartDebuggingRequest": False,
-            },
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(INITIALIZE_REQUEST)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def send_disconnect(self):
-        msg = {
-            "command": "disconnect",
-            "terminateDebuggee": True,
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(DISCONNECT_REQUEST)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def send_variables(self, variables_reference: int):
-        msg = {
-            "command": "variables",
-            "arguments": {"variablesReference": variables_reference},
-        }
-        sent_message = self.client.send_request(msg)
-        self.awaiting_response[sent_message["seq"]] = sent_message
+        self.send_variables_many([variables_reference])
+
+    def send_variables_many(self, variables_references: list[int]):
+        for sent_message in self.client.send_prepared_many(VARIABLES_REQUEST, variables_references):
+            self.awaiting_response[sent_message["seq"]] = sent_message
 
     def send_stack_trace(self, thread_id: ThreadId):
-        msg = {
-            "command": "stackTrace",
-            "arguments": {
-                "threadId": thread_id,
-            },
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(STACK_TRACE_REQUEST, thread_id)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def send_scopes(self, frame: StackFrame):
-        msg = {
-            "command": "scopes",
-            "arguments": {
-                "frameId": frame.id,
-            },
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(SCOPES_REQUEST, frame.id)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def configuration_done(self):
-        msg = {
-            "command": "configurationDone",
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(CONFIGURATION_DONE_REQUEST)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def send_threads(self):
-        msg = {
-            "command": "threads",
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(THREADS_REQUEST)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def send_attach(self):
-        msg = {
-            "command": "attach",
-            "arguments": {
-                "name": "Python: Remote Attach (ext)",
-                "type": "python",
-                "request": "attach",
-                "justMyCode": False,
-            },
-            "type": "request",
-            "seq": 2,
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(ATTACH_REQUEST)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def launch(self):
-        msg = {
-            "command": "launch",
-            "arguments": {
-                "program": os.path.join(os.getcwd(), "test.py"),
-            },
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(self.launch_request)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def send_continue(self):
@@ -404,110 +582,218 @@ class Handler:
         self.awaiting_response[sent_message["seq"]] = sent_message
 
     def set_function_breakpoints(self):
-        msg = {
-            "command": "setFunctionBreakpoints",
-            "arguments": {
-                "breakpoints": [
-                    {"name": "main"},
-                ],
-            },
-        }
-        sent_message = self.client.send_request(msg)
+        sent_message = self.client.send_prepared(SET_FUNCTION_BREAKPOINTS_REQUEST)
         self.awaiting_response[sent_message["seq"]] = sent_message
 
 
-def parse_header(header_text: str) -> Header:
-    key, value = header_text.split(":")
-    assert key.strip() == "Content-Length"
-    return Header(content_length=int(value.strip()))
-
-
 class Client:
     def __init__(self, host: str = "127.0.0.1", port: int = 5678):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # large variables responses should fit in the kernel buffer; set before connecting so
+        # the TCP window scale is negotiated for the larger size
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 18)
         self.sock.connect((host, port))
+        LOG.info(
+            "socket buffers",
+            rcvbuf=self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            sndbuf=self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+        )
+        # requests are small and latency bound, so do not wait to coalesce them
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.seq = 1
-        self.buf = ""
-
+        self.buf = bytearray()
+        # requests are written by a separate thread so message handling never blocks on the socket
+        self.send_queue: SimpleQueue[bytes | None] = SimpleQueue()
+        self.writer = Thread(target=self.write_requests, name="request-writer", daemon=True)
+        # set by the writer thread if a write fails, after which no more requests can be sent
+        self.send_error: OSError | None = None
+        self.writer_closed = False
+        self.writer.start()
+        atexit.register(self.close_writer)
+        self.recv_buf = bytearray(65536)
+        self.recv_view = memoryview(self.recv_buf)
+
+    # NOTE: fills in the envelope fields on `msg` itself, so callers must pass a dict they own
     def send_request(self, msg: dict) -> dict:
-        full_message = {
-            **msg,
-            **{
-                "seq": self.seq,
-                "type": "request",
-            },
-        }
-        LOG.debug("request", request=full_message)
-        buf = serislise_message(full_message)
-        self.sock.send(buf)
+        self.check_writer()
+        msg["seq"] = self.seq
+        msg["type"] = "request"
+        if DEBUG_ENABLED:
+            LOG.debug("request", request=msg)
+        buf = serislise_message(msg)
+        self.send_queue.put(buf)
+        self.seq += 1
+        return msg
+
+    def send_prepared(self, request: PreparedRequest, *arguments: int) -> dict:
+        self.check_writer()
+        seq = self.seq
+        sent_message = request.envelope(seq, *arguments)
+        if DEBUG_ENABLED:
+            LOG.debug("request", request=sent_message)
+        self.send_queue.put(frame_message(request.template % (*arguments, seq)))
         self.seq += 1
-        return full_message
+        return sent_message
+
+    # sends one request per argument for a single-argument template, framed into one buffer
+    def send_prepared_many(self, request: PreparedRequest, arguments: list[int]) -> list[dict]:
+        self.check_writer()
+        first = self.seq
+        sent_messages = [
+            request.envelope(seq, argument) for seq, argument in enumerate(arguments, first)
+        ]
+        if DEBUG_ENABLED:
+            for sent_message in sent_messages:
+                LOG.debug("request", request=sent_message)
+        template = request.template
+        self.send_queue.put(
+            b"".join(
+                frame_message(template % (argument, seq))
+                for seq, argument in enumerate(arguments, first)
+            )
+        )
+        self.seq += len(arguments)
+        return sent_messages
+
+    def write_requests(self):
+        running = True
+        while running:
+            parts = []
+            buf = self.send_queue.get()
+            # coalesce anything queued behind it into the same write, stopping at the None
+            # close_writer puts after the final request
+            while True:
+                if buf is None:
+                    running = False
+                    break
+                parts.append(buf)
+                if self.send_queue.empty():
+                    break
+                buf = self.send_queue.get()
+
+            if parts:
+                try:
+                    self.sock.sendall(b"".join(parts))
+                except OSError as e:
+                    LOG.warning("could not send requests", exc_info=e)
+                    self.send_error = e
+                    return
+
+    def check_writer(self):
+        if self.send_error is not None:
+            raise ConnectionError("could not send requests") from self.send_error
+        if self.writer_closed:
+            raise ConnectionError("request writer is closed")
+
+    def close_writer(self):
+        self.writer_closed = True
+        self.send_queue.put(None)
+        # do not hang at exit if the adapter has stopped reading and sendall is blocked
+        self.writer.join(timeout=5)
 
     def receive_message(self) -> Generator[ServerMessage, None, None]:
         try:
-            m = self.sock.recv(8196).decode("utf8")
+            n = self.sock.recv_into(self.recv_buf)
         except OSError:
             LOG.warning("nothing read")
             # EOF
             raise SystemExit(0)
 
-        self.buf += m
-        # TODO: what if more headers are added?
-        assert self.buf.startswith("Content-Length")
+        if n == 0:
+            LOG.info("connection closed")
+            raise SystemExit(0)
 
-        while True:
-            # try to read a single message
+        self.buf += self.recv_view[:n]
+
+        # a full read means more data is probably waiting, so pull it in without blocking
+        eof = False
+        while MSG_DONTWAIT is not None and n == len(self.recv_buf):
             try:
-                header_str, _, rest = self.buf.split("\r\n", 2)
-            except ValueError:
+                n = self.sock.recv_into(self.recv_buf, 0, MSG_DONTWAIT)
+            except BlockingIOError:
                 break
-
-            header = parse_header(header_str)
-            if header.content_length <= 0:
-                raise RuntimeError(f"Invalid content length read: {header=}")
-
-            if len(rest) < header.content_length:
-                # not enough data in the buffer so receive again
+            except OSError:
+                LOG.warning("nothing read")
+                eof = True
                 break
+            if n == 0:
+                eof = True
+                break
+            self.buf += self.recv_view[:n]
 
-            body_str = rest[: header.content_length]
-            self.buf = rest[header.content_length :]
-
-            try:
-                res = json.loads(body_str)
-            except json.JSONDecodeError as e:
-                raise RuntimeError("could not read message body") from e
+        if TCP_QUICKACK is not None:
+            # the kernel clears this after it sends an ACK, so set it again after every read
+            self.sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
 
-            yield res
+        # offset of the first unconsumed byte, so the buffer is only compacted once per read
+        pos = 0
+        try:
+            while True:
+                # try to read a single message
+                header_end = self.buf.find(b"\r\n\r\n", pos)
+                if header_end < 0:
+                    break
+
+                # TODO: what if more headers are added?
+                if not self.buf.startswith(CONTENT_LENGTH_PREFIX, pos):
+                    raise RuntimeError(f"Invalid message header: {bytes(self.buf[pos:header_end])!r}")
+
+                try:
+                    content_length = int(self.buf[pos + len(CONTENT_LENGTH_PREFIX) : header_end])
+                except ValueError as e:
+                    raise RuntimeError(f"Invalid message header: {bytes(self.buf[pos:header_end])!r}") from e
+                if content_length <= 0:
+                    raise RuntimeError(f"Invalid content length read: {content_length=}")
+
+                body_start = header_end + 4
+                body_end = body_start + content_length
+                if len(self.buf) < body_end:
+                    # not enough data in the buffer so receive again
+                    break
+
+                pos = body_end
+
+                # parse in place; the view must be released before the buffer is resized
+                with memoryview(self.buf)[body_start:body_end] as body:
+                    try:
+                        res = json_loads(body)
+                    except json.JSONDecodeError as e:
+                        raise RuntimeError("could not read message body") from e
+
+                yield res
+        finally:
+            del self.buf[:pos]
+
+        # the messages read before the connection closed have been handled, so stop now
+        if eof:
+            LOG.info("connection closed")
+            raise SystemExit(0)
 
     def disconnect(self):
         self.sock.close()
 
 
-def receive_messages(client: Client, events: Queue):
+def run(client: Client, handler: Handler):
     try:
         while True:
             for msg in client.receive_message():
-                events.put(msg)
+                handler.dispatch(msg)
     except Exception as e:
         LOG.warning("background thread error", exc_info=e)
 
 
 if __name__ == "__main__":
-    queue = Queue()
     client = Client(port=5678)
+    handler = Handler(client)
     message_handler = Thread(
-        target=receive_messages,
+        target=run,
         name="message-handler",
-        kwargs=dict(client=client, events=queue),
+        kwargs=dict(client=client, handler=handler),
         daemon=True,
     )
     message_handler.start()
 
-    handler = Handler(client, queue)
-    ht = Thread(target=handler.loop, name="handler-loop", daemon=True)
-    ht.start()
-
     handler.send_initialize()
     handler.wait_for_connect()
     breakpoint()